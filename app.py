@@ -1,11 +1,10 @@
 import streamlit as st
-import openpyxl
-from openpyxl.styles import PatternFill
 import io
 import re
-import copy
 import base64
 
+# openpyxl は実行ボタン押下時にだけ読み込む（画面の再描画ごとの import を避ける）
+
 # ─────────────────────────────────────────────
 # 組み込みベースExcel（25-26シーズン　旭川総体）
 # ─────────────────────────────────────────────
@@ -18,8 +17,23 @@ st.title("🏟️ 座席マップ 青塗りツール")
 st.caption("クラス名＋列＋座席番号を入力し、座席シートのセルを青色に塗りつぶします")
 
 # ─────────────────────────────────────────────
-# 1. パース関数
+# 1. パース・索引関数
 # ─────────────────────────────────────────────
+# クラス名 + 列 + 座席番号（クラス名は Class SS-T / Class A End-1 など2〜3トークン）
+# クラス名の各トークンは次の「Class 」の手前で止め、座席番号は英字を含まないため、
+# 1件の一致が次のエントリにまたがることはない
+_TOKEN = r'(?:(?!Class\s)\S)+'
+# 座席番号の文字（エントリ末尾の空白＝次の「Class 」or 文末の直前の空白は含めない）
+_SEAT_CHAR = r'(?:[\d,.]|\s(?!\s*(?:Class\s|\Z)))'
+_MAIN_RE = re.compile(
+    rf'(?P<cls>Class\s+{_TOKEN}(?:\s+{_TOKEN})?)\s+(?P<row>\d+)列\s*(?P<seats>{_SEAT_CHAR}+)'
+)
+# 全角スペース・全角区切り文字→半角（区切り文字は「,」「.」に寄せる）
+_HALFWIDTH = (('\u3000', ' '), ('，', ','), ('、', ','), ('．', '.'), ('・', '.'))
+# 座席番号の区切り文字
+_SEP = re.compile(r'[,.\s]+')
+
+
 def parse_seat_text(text):
     """
     テキストから (class_name, row_num, seat_num) のリストを返す
@@ -28,55 +42,84 @@ def parse_seat_text(text):
       Class SS End-1 2列　8、9
       Class A Side 3列8,9
     """
-    results = []
+    # 重複排除を兼ねて dict のキーに入力順で蓄積
+    results = {}
+
+    # 全角スペース・区切り文字→半角
+    for full, half in _HALFWIDTH:
+        text = text.replace(full, half)
+
+    # 「Class」で始まるエントリを全文から順に取り出す
+    # クラス名パターン: Class SS-T / Class SS End-1 / Class S South / Class A Side など
+    # 列パターン: 数字 + 列
+    # 座席パターン: 数字（複数は "、" "," "." で区切り or "25.26" のような形）
+    for m in _MAIN_RE.finditer(text):
+        class_name = m.group('cls').strip()
+        row_num = int(m.group('row'))
+        seat_str = m.group('seats')
+
+        # 座席番号を展開 (区切り文字: , . 空白)
+        seat_parts = _SEP.split(seat_str.strip())
+        for sp in seat_parts:
+            sp = sp.strip()
+            if sp.isdigit():
+                results[(class_name, row_num, int(sp))] = None
 
-    # 改行 or 「Class」の前で分割
-    # まず全行を「Class」で分割して各エントリを処理
-    # 全角スペース→半角
-    text = text.replace('\u3000', ' ').replace('　', ' ')
+    return list(results)
 
-    # Classで始まるブロックに分割
-    blocks = re.split(r'(?=Class\s)', text)
 
-    for block in blocks:
-        block = block.strip()
-        if not block:
-            continue
+def normalize_class(s):
+    """連続スペースを1つにして比較用に正規化"""
+    return ' '.join(str(s).split())
 
-        # クラス名パターン: Class SS-T / Class SS End-1 / Class S South / Class A Side など
-        # 列パターン: 数字 + 列
-        # 座席パターン: 数字（複数は "、" "," "." で区切り or "25.26" のような形）
-        m = re.match(
-            r'(Class\s+\S+(?:\s+\S+)?)\s+(\d+)列\s*([\d\s、,．.・]+)',
-            block
-        )
-        if not m:
-            # クラス名が3トークンのパターン試行: Class A End-1 など
-            m = re.match(
-                r'(Class\s+\S+\s+\S+)\s+(\d+)列\s*([\d\s、,．.・]+)',
-                block
-            )
-        if not m:
-            continue
 
-        class_name = m.group(1).strip()
-        row_num = int(m.group(2))
-        seat_str = m.group(3)
+@st.cache_data(show_spinner=False, max_entries=4)
+def build_coord_map(xlsx_bytes):
+    """
+    クラス・列・座席番号シートから {(class_name, row_val, seat_val): (r, c)} を返す
+    同じファイルでの再実行時はキャッシュを返し、全セル走査を省略する
+    """
+    import openpyxl
+
+    wb_ro = openpyxl.load_workbook(io.BytesIO(xlsx_bytes), read_only=True, data_only=True)
+
+    sheets = [
+        wb_ro['25－26ブロックマップ_クラス'],
+        wb_ro['25－26ブロックマップ_列'],
+        wb_ro['25－26ブロックマップ_座席番号'],
+    ]
+    # 保存されたサイズ情報（<dimension>）は古い・欠けている場合があるので使わない
+    for ws in sheets:
+        ws.reset_dimensions()
+
+    # 3シートを行単位で並走させ、値のタプルから直接インデックス化
+    coord_map = {}
+    rows = zip(*(ws.iter_rows(values_only=True) for ws in sheets))
+
+    for r, (cv_row, rv_row, sv_row) in enumerate(rows, 1):
+        # クラスが空の行は読み飛ばす（空欄・0 などはクラス名として一致しえない）
+        if not any(cv_row):
+            continue
+        for c, (cv, rv, sv) in enumerate(zip(cv_row, rv_row, sv_row), 1):
+            if cv is None or rv is None or sv is None:
+                continue
 
-        # 座席番号を展開 (区切り文字: 、, ．.)
-        seat_parts = re.split(r'[、,．.\s・]+', seat_str.strip())
-        for sp in seat_parts:
-            sp = sp.strip()
-            if sp.isdigit():
-                results.append((class_name, row_num, int(sp)))
+            # 数値シートではほぼ int のまま届くので変換を省略
+            if isinstance(rv, int) and isinstance(sv, int):
+                rv_int, sv_int = rv, sv
+            else:
+                try:
+                    rv_int = int(rv)
+                    sv_int = int(sv)
+                except (ValueError, TypeError):
+                    continue
 
-    # 重複排除
-    return list(set(results))
+            cv_norm = normalize_class(str(cv))
 
+            coord_map[(cv_norm, rv_int, sv_int)] = (r, c)
 
-def normalize_class(s):
-    """連続スペースを1つにして比較用に正規化"""
-    return re.sub(r'\s+', ' ', str(s).strip())
+    wb_ro.close()
+    return coord_map
 
 
 # ─────────────────────────────────────────────
@@ -127,6 +170,9 @@ run = st.button("🎨 青塗り実行", type="primary", disabled=(not excel_read
 # 3. 処理
 # ─────────────────────────────────────────────
 if run:
+    import openpyxl
+    from openpyxl.styles import PatternFill
+
     with st.spinner("処理中..."):
         # パース
         seats = parse_seat_text(seat_text)
@@ -136,14 +182,21 @@ if run:
 
         st.write(f"**解析された座席数:** {len(seats)} 件")
 
+        # 照合用のクラス名を先に正規化（表示用に元の表記も保持）
+        seats = [(normalize_class(c), r, s, c) for (c, r, s) in seats]
+
         # Excelロード（組み込み or アップロード）
         if excel_choice == "ファイルをアップロード":
-            excel_bytes = io.BytesIO(uploaded.read())
+            # UploadedFile は BytesIO 派生なので getvalue() で読み位置に関係なく全体を取得
+            if hasattr(uploaded, "getvalue"):
+                excel_data = uploaded.getvalue()
+            else:
+                excel_data = uploaded.read()
             source_name = uploaded.name.replace(".xlsx", "")
         else:
-            excel_bytes = io.BytesIO(base64.b64decode(BUILTIN_EXCEL_B64))
+            excel_data = base64.b64decode(BUILTIN_EXCEL_B64)
             source_name = BUILTIN_EXCEL_NAME
-        wb = openpyxl.load_workbook(excel_bytes)
+        wb = openpyxl.load_workbook(io.BytesIO(excel_data))
 
         required_sheets = ['25－26ブロックマップ_座席番号', '25－26ブロックマップ_列', '25－26ブロックマップ_クラス']
         missing = [s for s in required_sheets if s not in wb.sheetnames]
@@ -151,78 +204,73 @@ if run:
             st.error(f"必要なシートが見つかりません: {missing}")
             st.stop()
 
-        ws_seat  = wb['25－26ブロックマップ_座席番号']
-        ws_row   = wb['25－26ブロックマップ_列']
-        ws_class = wb['25－26ブロックマップ_クラス']
+        ws_seat = wb['25－26ブロックマップ_座席番号']
 
         BLUE_FILL = PatternFill("solid", fgColor="0000FF")
+        # 青塗りの fill はブックに1度だけ登録し、以降はセルの fillId だけを差し替える
+        blue_fill_id = wb._fills.add(BLUE_FILL)
 
         # セル座標マップ構築: (class_name, row_val, seat_val) -> (r, c)
-        # 全セルを走査してインデックス化
-        coord_map = {}
-        max_row = ws_class.max_row
-        max_col = ws_class.max_column
-
-        for r in range(1, max_row + 1):
-            for c in range(1, max_col + 1):
-                cv = ws_class.cell(row=r, column=c).value
-                rv = ws_row.cell(row=r, column=c).value
-                sv = ws_seat.cell(row=r, column=c).value
-
-                if cv is None or rv is None or sv is None:
-                    continue
-
-                cv_norm = normalize_class(str(cv))
-                try:
-                    rv_int = int(rv)
-                except (ValueError, TypeError):
-                    continue
-                try:
-                    sv_int = int(sv)
-                except (ValueError, TypeError):
-                    continue
-
-                coord_map[(cv_norm, rv_int, sv_int)] = (r, c)
+        coord_map = build_coord_map(excel_data)
 
         # 突合＆塗り
-        matched = []
-        unmatched = []
-
-        for (class_name, row_num, seat_num) in seats:
-            key = (normalize_class(class_name), row_num, seat_num)
-            if key in coord_map:
-                r, c = coord_map[key]
-                ws_seat.cell(row=r, column=c).fill = BLUE_FILL
-                matched.append({
-                    "クラス": class_name,
-                    "列": row_num,
-                    "座席": seat_num,
-                    "セル": f"R{r}C{c}"
-                })
+        # 表示用に列ごとのリストで保持（st.dataframe にそのまま渡せる）
+        matched = {"クラス": [], "列": [], "座席": [], "セル": []}
+        unmatched = {"クラス": [], "列": [], "座席": []}
+        hit_cells = []
+
+        for (class_norm, row_num, seat_num, class_name) in seats:
+            rc = coord_map.get((class_norm, row_num, seat_num))
+            if rc is not None:
+                r, c = rc
+                hit_cells.append(rc)
+                matched["クラス"].append(class_name)
+                matched["列"].append(row_num)
+                matched["座席"].append(seat_num)
+                matched["セル"].append(f"R{r}C{c}")
+            else:
+                unmatched["クラス"].append(class_name)
+                unmatched["列"].append(row_num)
+                unmatched["座席"].append(seat_num)
+
+        # 塗りはシートの行→列の順にまとめて適用（表の並びは入力順のまま）
+        for r, c in sorted(hit_cells):
+            cell = ws_seat._cells.get((r, c))
+            if cell is not None and cell._style is not None:
+                cell._style.fillId = blue_fill_id
             else:
-                unmatched.append({
-                    "クラス": class_name,
-                    "列": row_num,
-                    "座席": seat_num
-                })
-
-        # 出力：セルを1つずつコピー（列幅を確実に指定通りに保つため）
-        from openpyxl import Workbook
+                ws_seat.cell(row=r, column=c).fill = BLUE_FILL
+
+        # 出力：座席シートだけを残してそのまま保存（セルのコピーは不要）
         from openpyxl.styles import PatternFill as PF, Font, Alignment
+        from openpyxl.cell.cell import MergedCell
         from openpyxl.utils import column_index_from_string, get_column_letter
-        from copy import copy as style_copy
-
-        ws_src = ws_seat
-        wb_out = Workbook()
-        wb_out.remove(wb_out.active)
-        ws_dst = wb_out.create_sheet(date_str)
-
-        # ── セルの値・スタイルをコピー（フォントキャッシュで高速化）──
+        from copy import copy
+
+        for name in list(wb.sheetnames):
+            if name != '25－26ブロックマップ_座席番号':
+                del wb[name]
+        ws_seat.title = date_str
+        # 元ブックで非表示でも、唯一のシートなので表示状態にしてからアクティブにする
+        ws_seat.sheet_state = "visible"
+        wb.active = ws_seat
+        # <bookViews> は省略可能なので、ある場合だけ先頭タブを合わせる
+        if wb.views:
+            wb.views[0].firstSheet = 0
+
+        # ── フォント11pt固定・中央揃え（元のスタイル単位でキャッシュして高速化）──
+        # 同じスタイルのセルは結果も同じなので、2セル目以降はスタイル配列をコピーするだけ
         CENTER = Alignment(horizontal="center", vertical="center")
         FONT_CACHE = {}
-        for row in ws_src.iter_rows():
+        STYLE_CACHE = {}
+        for row in ws_seat.iter_rows():
             for cell in row:
-                new_cell = ws_dst.cell(row=cell.row, column=cell.column, value=cell.value)
+                style_key = tuple(cell._style) if cell._style is not None else None
+                cached = STYLE_CACHE.get(style_key)
+                if cached is not None:
+                    cell._style = copy(cached)
+                    continue
+
                 # フォント（11pt固定・他属性は元のまま）
                 orig = cell.font
                 try:
@@ -235,30 +283,26 @@ if run:
                         name=orig.name or "Calibri", size=11,
                         bold=orig.bold, italic=orig.italic, color=orig.color,
                     )
-                new_cell.font      = FONT_CACHE[key]
-                new_cell.alignment = CENTER
-                if cell.has_style:
-                    new_cell.border        = style_copy(cell.border)
-                    new_cell.fill          = style_copy(cell.fill)
-                    new_cell.number_format = cell.number_format
+                cell.font      = FONT_CACHE[key]
+                cell.alignment = CENTER
+                STYLE_CACHE[style_key] = copy(cell._style)
 
         # ── X列(24列)行7-18の塗り・Y列(25列)行7-12の値をクリア ──
+        # 結合セルの左上以外（MergedCell）は値を持てないので値のクリアは飛ばす
         for r in range(7, 19):
-            ws_dst.cell(row=r, column=24).fill  = PF(fill_type=None)
-            ws_dst.cell(row=r, column=24).value = None
+            ws_seat.cell(row=r, column=24).fill  = PF(fill_type=None)
+            if not isinstance(ws_seat.cell(row=r, column=24), MergedCell):
+                ws_seat.cell(row=r, column=24).value = None
         for r in range(7, 13):
-            ws_dst.cell(row=r, column=25).value = None
-            ws_dst.cell(row=r, column=25).fill  = PF(fill_type=None)
-
-        # ── 結合セルをコピー ──
-        for merge in ws_src.merged_cells.ranges:
-            ws_dst.merge_cells(str(merge))
+            if not isinstance(ws_seat.cell(row=r, column=25), MergedCell):
+                ws_seat.cell(row=r, column=25).value = None
+            ws_seat.cell(row=r, column=25).fill  = PF(fill_type=None)
 
         # ── 列幅の設定（31px / 38px / 41px）──
         COL_41PX = 5.1429
         COL_38PX = 4.7143
         COL_31PX = 3.7143
-        MAX_COL  = ws_src.max_column
+        MAX_COL  = ws_seat.max_column
 
         RANGES_31PX = [
             ("A", "M"), ("S", "Y"), ("AA", "AK"),
@@ -278,26 +322,21 @@ if run:
         cols_31px = build_col_set(RANGES_31PX)
         cols_38px = build_col_set(RANGES_38PX)
 
-        ws_dst.sheet_format.defaultColWidth  = COL_41PX
-        ws_dst.sheet_format.defaultRowHeight = ws_src.sheet_format.defaultRowHeight
-        ws_dst.sheet_format.customHeight     = ws_src.sheet_format.customHeight
+        # 元シートの列定義は複数列をまとめた範囲を含むため、作り直してから設定
+        ws_seat.column_dimensions.clear()
+        ws_seat.sheet_format.defaultColWidth = COL_41PX
 
         for i in range(1, MAX_COL + 1):
             col_letter = get_column_letter(i)
             if i in cols_31px:
-                ws_dst.column_dimensions[col_letter].width = COL_31PX
+                ws_seat.column_dimensions[col_letter].width = COL_31PX
             elif i in cols_38px:
-                ws_dst.column_dimensions[col_letter].width = COL_38PX
+                ws_seat.column_dimensions[col_letter].width = COL_38PX
             else:
-                ws_dst.column_dimensions[col_letter].width = COL_41PX
-
-        # ── 行高をコピー ──
-        for row, rd in ws_src.row_dimensions.items():
-            ws_dst.row_dimensions[row].height = rd.height
-
+                ws_seat.column_dimensions[col_letter].width = COL_41PX
 
         out_buf = io.BytesIO()
-        wb_out.save(out_buf)
+        wb.save(out_buf)
         out_buf.seek(0)
 
         out_name = f"{source_name}_{date_str}_blue_marked.xlsx"
@@ -305,20 +344,22 @@ if run:
     # ─────────────────────────────────────────────
     # 4. 結果表示
     # ─────────────────────────────────────────────
-    st.success(f"✅ 完了！ 塗り: {len(matched)}件 / 未一致: {len(unmatched)}件")
+    n_matched = len(matched["クラス"])
+    n_unmatched = len(unmatched["クラス"])
+    st.success(f"✅ 完了！ 塗り: {n_matched}件 / 未一致: {n_unmatched}件")
 
     col_a, col_b = st.columns(2)
 
     with col_a:
-        st.subheader(f"✅ 塗れた席（{len(matched)}件）")
-        if matched:
+        st.subheader(f"✅ 塗れた席（{n_matched}件）")
+        if n_matched:
             st.dataframe(matched, use_container_width=True)
         else:
             st.info("一致なし")
 
     with col_b:
-        st.subheader(f"❌ 塗れなかった席（{len(unmatched)}件）")
-        if unmatched:
+        st.subheader(f"❌ 塗れなかった席（{n_unmatched}件）")
+        if n_unmatched:
             st.dataframe(unmatched, use_container_width=True)
             st.caption("クラス名・列・座席番号がデータに存在しない可能性があります")
         else: